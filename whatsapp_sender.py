@@ -8,39 +8,58 @@ st.set_page_config(
 )
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pac
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import aiohttp
+import asyncio
+from aiolimiter import AsyncLimiter
+import orjson
+import hashlib
+import tempfile
 import time
 import io
 import re
 import os
+from pathlib import Path
 
 # --- Helper: normalize phone numbers ---
-def normalize_number(raw):
+def normalize_numbers(raw):
     # accept strings like "+64 210 241 5992", "'+64 ...", "<+64 ...>", etc.
-    s = str(raw).strip()
-    s = s.replace("\u200b", "")            # remove zero-width chars
-    s = re.sub(r"[<>]", "", s)             # drop angle brackets
-    s = s.lstrip(" '\"")                   # drop leading quotes/spaces
-
-    # keep only digits; treat leading '+' or '00' as international
-    if s.startswith("+"):
-        digits = re.sub(r"\D", "", s)      # strip '+' and non-digits
-    else:
-        digits = re.sub(r"\D", "", s)
-        if digits.startswith("00"):
-            digits = digits[2:]            # convert 00XX… to international
-        # Singapore fallbacks for local-looking numbers
-        if len(digits) == 8:
-            digits = "65" + digits
-        elif len(digits) == 9 and digits.startswith("0"):
-            digits = "65" + digits[1:]
+    # works column-wide on Arrow kernels; expects a string column (see the
+    # read_csv call below) and returns null for invalid rows
+    # international if '+' is the first character after whitespace, zero-width
+    # chars, angle brackets and quotes; RE2's \s misses NBSP and \v, so trim
+    # with the Unicode-aware kernel first
+    trimmed = pc.utf8_trim_whitespace(raw)
+    intl = pc.match_substring_regex(trimmed, "^[\u200b<> '\"]*\\+")
+    digits = pc.replace_substring_regex(raw, r"\D", "")   # keep only digits
+
+    # local numbers: 00XX… is international, else Singapore fallbacks
+    local = pc.invert(intl)
+    digits = pc.if_else(
+        pc.and_(local, pc.starts_with(digits, "00")),
+        pc.utf8_slice_codeunits(digits, 2),
+        digits,
+    )
+    length = pc.utf8_length(digits)
+    m8 = pc.and_(local, pc.equal(length, 8))
+    m9 = pc.and_(pc.and_(local, pc.equal(length, 9)), pc.starts_with(digits, "0"))
+    digits = pc.if_else(
+        m8, pc.binary_join_element_wise("65", digits, ""),
+        pc.if_else(m9, pc.binary_join_element_wise("65", pc.utf8_slice_codeunits(digits, 1), ""), digits),
+    )
 
     # basic sanity: 8–15 digits, no leading 0 in final form
-    if not digits or digits.startswith("0"):
-        return None
-    if not (8 <= len(digits) <= 15):
-        return None
-    return digits  # send this to WhatsApp API
+    length = pc.utf8_length(digits)
+    valid = pc.and_(
+        pc.and_(pc.greater_equal(length, 8), pc.less_equal(length, 15)),
+        pc.invert(pc.starts_with(digits, "0")),
+    )
+    return pc.if_else(valid, digits, pa.scalar(None, pa.string()))
 
 # --- Credentials storage (local fallback) ---
 CRED_FILE = "config.txt"
@@ -50,7 +69,7 @@ def load_credentials():
     if creds and all(k in creds for k in ("access_token","phone_number_id","business_account_id")):
         return creds["access_token"], creds["phone_number_id"], creds["business_account_id"]
     if os.path.exists(CRED_FILE):
-        lines = [l.strip() for l in open(CRED_FILE) if l.strip()]
+        lines = [l.strip() for l in Path(CRED_FILE).read_text().splitlines() if l.strip()]
         if len(lines) >= 3:
             return lines[0], lines[1], lines[2]
     return "", "", ""
@@ -61,14 +80,146 @@ def save_credentials(token, phone_id, business_id):
 
 ACCESS_TOKEN, PHONE_NUMBER_ID, BUSINESS_ACCOUNT_ID = load_credentials()
 
+# --- Shared HTTP session (keep-alive across reruns and users) ---
+HTTP_TIMEOUT = (5, 30)   # (connect, read) seconds
+
+@st.cache_resource
+def get_http_session():
+    s = requests.Session()
+    # own backoff only: an uncapped Retry-After would freeze the page mid-rerun
+    retry = Retry(
+        total=3, backoff_factor=0.5,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False,
+    )
+    s.mount("https://", HTTPAdapter(pool_maxsize=64, max_retries=retry))
+    return s
+
 # --- Fetch WhatsApp Templates ---
-@st.cache_data(ttl=3600)
+TEMPLATE_CACHE_DIR = ".cache"
+TEMPLATE_TTL = 3600   # seconds
+
+def template_cache_path(token, business_id):
+    key = hashlib.sha256(f"{token}:{business_id}".encode()).hexdigest()
+    return os.path.join(TEMPLATE_CACHE_DIR, f"{key}.json")
+
+@st.cache_resource(ttl=TEMPLATE_TTL)
 def get_whatsapp_templates(token, business_id):
+    # on-disk copy keeps the list warm across restarts
+    path = template_cache_path(token, business_id)
+    if os.path.exists(path) and time.time() - os.path.getmtime(path) < TEMPLATE_TTL:
+        with open(path, "rb") as f:
+            return orjson.loads(f.read())
+
     url = f"https://graph.facebook.com/v18.0/{business_id}/message_templates"
     params = {"access_token": token, "fields": "name,components,status,language"}
-    resp = requests.get(url, params=params)
-    data = resp.json().get("data", [])
-    return [tpl for tpl in data if tpl.get("status") == "APPROVED"]
+    resp = get_http_session().get(url, params=params, timeout=HTTP_TIMEOUT)
+    if not resp.ok:
+        # raise so nothing is cached and the dropdown shows the error
+        try:
+            msg = orjson.loads(resp.content).get("error", {}).get("message", "")
+        except Exception:
+            msg = ""
+        raise RuntimeError(f"Graph API returned {resp.status_code}: {msg or resp.reason}")
+    data = orjson.loads(resp.content).get("data", [])
+    templates = [tpl for tpl in data if tpl.get("status") == "APPROVED"]
+
+    # write-then-rename so other sessions never read a half-written file
+    os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=TEMPLATE_CACHE_DIR, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(orjson.dumps(templates))
+    os.replace(tmp_path, path)
+    return templates
+
+@st.cache_data
+def render_preview(template_name, components):
+    # components: tuple of (type, format, text), hashable so reruns hit the cache;
+    # returns one markdown blob so the preview is a single element
+    parts = []
+    for comp_type, comp_format, text in components:
+        if comp_type == "HEADER" and comp_format == "TEXT":
+            parts.append(f"**Header:** {text or ''}\n")
+        elif comp_type == "BODY":
+            # fence must be longer than any backtick run in the body, or it breaks out
+            text = text or ""
+            longest = max((len(run) for run in re.findall(r"`+", text)), default=0)
+            fence = "`" * max(3, longest + 1)
+            parts.append(f"{fence}text\n{text}\n{fence}\n")
+    return "\n".join(parts)
+
+# --- Send WhatsApp Messages ---
+SEND_CONCURRENCY = 32   # max in-flight POSTs
+SEND_RATE = 80          # messages per second (Cloud API default throughput)
+SEND_ATTEMPTS = 3
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+def retry_delay(retry_after, attempt):
+    # honour Retry-After (seconds) when given, else exponential backoff; both capped at 30s
+    try:
+        return min(max(float(retry_after), 0), 30)
+    except (TypeError, ValueError):
+        return min(2 ** attempt, 30)
+
+async def send_one(sess, sem, limiter, url, base_payload, num):
+    payload = orjson.dumps({**base_payload, "to": num})
+    async with sem:
+        for attempt in range(SEND_ATTEMPTS):
+            retry_after = None
+            connect_failed = False
+            async with limiter:
+                try:
+                    async with sess.post(url, data=payload) as resp:
+                        # read the body either way so the connection goes back to the pool
+                        body = await resp.read()
+                        status_code = resp.status
+                        if status_code == 200:
+                            err = ""   # success: nothing worth decoding
+                        else:
+                            try:
+                                err = orjson.loads(body).get("error", {}).get("message", "")
+                            except Exception:
+                                err = body.decode("utf-8", "replace")
+                        retry_after = resp.headers.get("Retry-After")
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # network failure: record it instead of aborting the whole batch
+                    status_code, err = None, str(e) or type(e).__name__
+                    # only a failed connect is safe to repeat; otherwise the POST may have landed
+                    connect_failed = isinstance(e, aiohttp.ClientConnectorError)
+            retryable = connect_failed or status_code in RETRY_STATUSES
+            if not retryable or attempt == SEND_ATTEMPTS - 1:
+                break
+            await asyncio.sleep(retry_delay(retry_after, attempt))
+    return num, status_code, err
+
+async def send_all(numbers, template_name, lang_code, on_result=None):
+    sem = asyncio.Semaphore(SEND_CONCURRENCY)
+    limiter = AsyncLimiter(SEND_RATE, 1)
+    url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
+    headers = {
+        "Authorization": f"Bearer {ACCESS_TOKEN}",
+        "Content-Type": "application/json"
+    }
+    # only "to" changes per message
+    base_payload = {
+        "messaging_product": "whatsapp",
+        "type": "template",
+        "template": {"name": template_name, "language": {"code": lang_code}}
+    }
+    # one keep-alive pool for the whole batch: TLS handshake once per connection
+    connector = aiohttp.TCPConnector(limit=64)
+    async with aiohttp.ClientSession(connector=connector, headers=headers) as sess:
+        async def run(num):
+            try:
+                result = await send_one(sess, sem, limiter, url, base_payload, num)
+            except Exception as e:
+                # one bad response must not cancel the rest of the batch
+                result = (num, None, str(e) or type(e).__name__)
+            if on_result:
+                on_result(*result)
+            return result
+        # results come back in the same order as `numbers`
+        return await asyncio.gather(*(run(num) for num in numbers))
 
 # --- Initialize session state ---
 st.session_state.setdefault("numbers", [])
@@ -110,27 +261,32 @@ with col_config:
     send_btn = btn_send.button("Send Messages")
     if btn_refresh.button("🔄", help="Refresh template list"):
         get_whatsapp_templates.clear()
+        cache_path = template_cache_path(ACCESS_TOKEN, BUSINESS_ACCOUNT_ID)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
         st.success("Template list refreshed.")
 
     # Template dropdown
+    tpl_by_name = {}
     try:
         templates = get_whatsapp_templates(ACCESS_TOKEN, BUSINESS_ACCOUNT_ID)
         names = [tpl["name"] for tpl in templates]
+        # first match wins, as with the old linear scan
+        tpl_by_name = {tpl["name"]: tpl for tpl in reversed(templates)}
         template_name = st.selectbox("WhatsApp Template", names)
     except Exception as e:
         st.error(f"Failed to load templates: {e}")
         template_name = st.text_input("Template Name", "hello_world")
 
     # Template preview
-    if 'templates' in locals() and template_name:
-        selected = next((tpl for tpl in templates if tpl["name"] == template_name), None)
-        if selected:
-            st.subheader("Template Preview")
-            for comp in selected.get("components", []):
-                if comp.get("type") == "HEADER" and comp.get("format") == "TEXT":
-                    st.markdown(f"**Header:** {comp.get('text','')}  ")
-                elif comp.get("type") == "BODY":
-                    st.code(comp.get("text",""), language="text")
+    selected = tpl_by_name.get(template_name)
+    if selected:
+        components = tuple(
+            (c.get("type"), c.get("format"), c.get("text"))
+            for c in selected.get("components", [])
+        )
+        st.subheader("Template Preview")
+        st.markdown(render_preview(template_name, components))
 
 with col_main:
     st.title("NCSF WhatsApp Lead Messenger")
@@ -138,10 +294,30 @@ with col_main:
 
     # ★ Process the CSV immediately on upload
     if file:
-        df_raw = pd.read_csv(file, header=None, names=["Raw Input"]).dropna()
-        df_raw["Phone Number"] = df_raw["Raw Input"].astype(str).apply(normalize_number)
-        valid_df = df_raw.dropna(subset=["Phone Number"])
-        st.session_state["numbers"] = valid_df["Phone Number"].tolist()
+        # multi-threaded C parser; rows stay in Arrow until the preview
+        try:
+            table = pac.read_csv(
+                file,
+                read_options=pac.ReadOptions(column_names=["Raw Input"]),
+                convert_options=pac.ConvertOptions(column_types={"Raw Input": pa.string()}),
+            )
+        except pa.ArrowInvalid as e:
+            # e.g. trailing commas from Excel: "Expected 1 columns, got 2"
+            st.error(f"Could not read the CSV (expected one column of numbers): {e}")
+            st.session_state["numbers"] = []
+        else:
+            table = table.drop_null()
+            table = table.append_column("Phone Number", normalize_numbers(table.column("Raw Input")))
+            valid = table.drop_null()
+            # order-preserving dedup: one message per number, first row wins
+            first_row = {}
+            for i, num in enumerate(valid.column("Phone Number").to_pylist()):
+                first_row.setdefault(num, i)
+            duplicates = valid.num_rows - len(first_row)
+            valid = valid.take(list(first_row.values()))   # preview matches what gets sent
+            st.session_state["numbers"] = list(first_row)
+            if duplicates:
+                st.info(f"Removed {duplicates} duplicate number(s).")
 
     # Handle sending
     if send_btn:
@@ -150,48 +326,38 @@ with col_main:
             st.error("No valid leads to send. Upload a valid CSV.")
         else:
             total = len(numbers)
-            success = failure = 0
-            log = []
             progress = st.progress(0)
             status_area = st.empty()
 
             # Determine language code
-            tpl = next((t for t in templates if t["name"] == template_name), None)
-            lang_entry = tpl.get("language") if tpl else {}
+            tpl = tpl_by_name.get(template_name)
+            lang_entry = tpl.get("language") if tpl else None
             lang_code = (
-                lang_entry.get("code") if isinstance(lang_entry, dict)
-                else (lang_entry or "en_US")
-            )
+                lang_entry.get("code") if isinstance(lang_entry, dict) else lang_entry
+            ) or "en_US"
 
-            for i, num in enumerate(numbers, start=1):
-                url = f"https://graph.facebook.com/v18.0/{PHONE_NUMBER_ID}/messages"
-                headers = {
-                    "Authorization": f"Bearer {ACCESS_TOKEN}",
-                    "Content-Type": "application/json"
-                }
-                payload = {
-                    "messaging_product": "whatsapp",
-                    "to": num,
-                    "type": "template",
-                    "template": {"name": template_name, "language": {"code": lang_code}}
-                }
-                resp = requests.post(url, headers=headers, json=payload)
-                try:
-                    err = resp.json().get("error", {}).get("message", "")
-                except Exception:
-                    err = resp.text
-
-                if resp.status_code == 200:
-                    success += 1
+            UI_INTERVAL = 0.1   # seconds between progress/status redraws
+            done = [0]   # shared completion counter, bumped as each send finishes
+            pending = []   # status lines since the last redraw
+            last_ui = [time.monotonic()]
+            def on_result(num, status_code, err):
+                done[0] += 1
+                if status_code == 200:
                     status = "Sent"
                 else:
-                    failure += 1
-                    status = f"Failed ({resp.status_code}): {err}"
+                    status = f"Failed ({status_code or 'network error'}): {err}"
+                pending.append(f"{done[0]}/{total} → {num}: {status}")
+                now = time.monotonic()
+                if now - last_ui[0] > UI_INTERVAL or done[0] == total:
+                    status_area.write("  \n".join(pending))
+                    progress.progress(done[0]/total)
+                    pending.clear()
+                    last_ui[0] = now
 
-                log.append([num, resp.status_code, err])
-                status_area.write(f"{i}/{total} → {num}: {status}")
-                progress.progress(i/total)
-                time.sleep(0.05)
+            results = asyncio.run(send_all(numbers, template_name, lang_code, on_result))
+            log = [list(r) for r in results]
+            success = sum(1 for _, status_code, _ in results if status_code == 200)
+            failure = total - success
 
             st.session_state["success"] = success
             st.session_state["failure"] = failure
@@ -201,7 +367,9 @@ with col_main:
                 st.success(f"Completed: {success} sent out of {total} leads.")
             # Download log
             df_log = pd.DataFrame(log, columns=["Phone Number","Status Code","Error Message"])
-            buf = io.StringIO()
+            # nullable ints: a network error (None) must not turn 200 into 200.0
+            df_log["Status Code"] = pd.array(df_log["Status Code"], dtype="Int64")
+            buf = io.BytesIO()
             df_log.to_csv(buf, index=False)
             st.download_button("Download Log", buf.getvalue(), "ncsf_log.csv", "text/csv")
 
@@ -217,9 +385,7 @@ with col_main:
     # Preview Uploaded Leads (NOW below the stats)
     if st.session_state["numbers"]:
         st.subheader("Preview Uploaded Leads")
-        df_preview = valid_df.reset_index(drop=True).rename(
-            columns={"Raw Input": "Input", "Phone Number": "Normalized"}
-        )
+        df_preview = valid.rename_columns(["Input", "Normalized"]).to_pandas()
         df_preview.index = df_preview.index + 1
         df_preview.index.name = "No."
         st.dataframe(df_preview, use_container_width=True)